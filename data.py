@@ -1,5 +1,6 @@
 import torch
 import torch.utils.data as data
+import torchvision
 import torchvision.transforms as transforms
 import os
 import nltk
@@ -9,6 +10,15 @@ import numpy as np
 import json as jsonmod
 
 
+def load_image(path, raw=False):
+    """Open an RGB image with PIL, or with `raw=True` read its (JPEG) bytes
+    into a uint8 tensor that `GPUDecodeLoader` decodes on the GPU.
+    """
+    if raw:
+        return torchvision.io.read_file(path)
+    return Image.open(path).convert('RGB')
+
+
 def get_paths(path, name='coco', use_restval=False):
     """
     Returns paths to images and annotations for the given datasets. For MSCOCO
@@ -78,13 +88,15 @@ def get_paths(path, name='coco', use_restval=False):
 class CocoDataset(data.Dataset):
     """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
 
-    def __init__(self, root, json, vocab, transform=None, ids=None):
+    def __init__(self, root, json, vocab, transform=None, ids=None,
+                 raw=False):
         """
         Args:
             root: image directory.
             json: coco annotation file path.
             vocab: vocabulary wrapper.
             transform: transformer for image.
+            raw: return the undecoded image bytes.
         """
         self.root = root
         # when using `restval`, two json files are needed
@@ -107,6 +119,7 @@ class CocoDataset(data.Dataset):
             self.bp = len(self.ids)
         self.vocab = vocab
         self.transform = transform
+        self.raw = raw
 
     def __getitem__(self, index):
         """This function returns a tuple that is further passed to collate_fn
@@ -119,7 +132,7 @@ class CocoDataset(data.Dataset):
 
         # Convert caption (string) to word ids.
         tokens = nltk.tokenize.word_tokenize(
-            str(caption).lower().decode('utf-8'))
+            str(caption).lower())
         caption = []
         caption.append(vocab('<start>'))
         caption.extend([vocab(token) for token in tokens])
@@ -138,10 +151,21 @@ class CocoDataset(data.Dataset):
         caption = coco.anns[ann_id]['caption']
         img_id = coco.anns[ann_id]['image_id']
         path = coco.loadImgs(img_id)[0]['file_name']
-        image = Image.open(os.path.join(root, path)).convert('RGB')
+        image = load_image(os.path.join(root, path), self.raw)
 
         return root, caption, img_id, path, image
 
+    def caption_info(self, index):
+        """Raw caption and image id of `index`, without loading the image"""
+        coco = self.coco[0] if index < self.bp else self.coco[1]
+        ann = coco.anns[self.ids[index]]
+        return ann['caption'], ann['image_id']
+
+    def caption_lengths(self):
+        """Approximate caption lengths (in words) used for bucketing"""
+        return [len(str(self.caption_info(index)[0]).split())
+                for index in range(len(self.ids))]
+
     def __len__(self):
         return len(self.ids)
 
@@ -151,11 +175,12 @@ class FlickrDataset(data.Dataset):
     Dataset loader for Flickr30k and Flickr8k full datasets.
     """
 
-    def __init__(self, root, json, split, vocab, transform=None):
+    def __init__(self, root, json, split, vocab, transform=None, raw=False):
         self.root = root
         self.vocab = vocab
         self.split = split
         self.transform = transform
+        self.raw = raw
         self.dataset = jsonmod.load(open(json, 'r'))['images']
         self.ids = []
         for i, d in enumerate(self.dataset):
@@ -172,7 +197,7 @@ class FlickrDataset(data.Dataset):
         caption = self.dataset[img_id]['sentences'][ann_id[1]]['raw']
         path = self.dataset[img_id]['filename']
 
-        image = Image.open(os.path.join(root, path)).convert('RGB')
+        image = load_image(os.path.join(root, path), self.raw)
         if self.transform is not None:
             image = self.transform(image)
 
@@ -186,6 +211,16 @@ class FlickrDataset(data.Dataset):
         target = torch.Tensor(caption)
         return image, target, index, img_id, index
 
+    def caption_info(self, index):
+        """Raw caption and image id of `index`, without loading the image"""
+        img_id, sent_id = self.ids[index]
+        return self.dataset[img_id]['sentences'][sent_id]['raw'], img_id
+
+    def caption_lengths(self):
+        """Approximate caption lengths (in words) used for bucketing"""
+        return [len(self.dataset[i]['sentences'][x]['raw'].split())
+                for i, x in self.ids]
+
     def __len__(self):
         return len(self.ids)
 
@@ -235,10 +270,47 @@ class PrecompDataset(data.Dataset):
         target = torch.Tensor(caption)
         return image, target, index, img_id, index
 
+    def caption_lengths(self):
+        """Approximate caption lengths (in words) used for bucketing"""
+        return [len(caption.split()) for caption in self.captions[:self.length]]
+
     def __len__(self):
         return self.length
 
 
+class BucketSampler(data.Sampler):
+    """Batch sampler that groups captions of similar length, so that the
+    padded batches fed to the RNN waste little compute on padding.
+
+    Every epoch the indices are shuffled and split into buckets of
+    `batch_size * bucket_factor` items, each bucket is sorted by caption
+    length and cut into batches, and the batches are shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_factor=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_factor
+
+    def __iter__(self):
+        perm = np.random.permutation(len(self.lengths))
+        batches = []
+        for i in range(0, len(perm), self.bucket_size):
+            bucket = perm[i:i + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches += [bucket[j:j + self.batch_size]
+                        for j in range(0, len(bucket), self.batch_size)]
+        np.random.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        n = len(self.lengths)
+        full, rest = divmod(n, self.bucket_size)
+        return (full * (self.bucket_size // self.batch_size)
+                + (rest + self.batch_size - 1) // self.batch_size)
+
+
 def collate_fn(data):
     """Build mini-batch tensors from a list of (image, caption) tuples.
     Args:
@@ -247,64 +319,137 @@ def collate_fn(data):
             - caption: torch tensor of shape (?); variable length.
 
     Returns:
-        images: torch tensor of shape (batch_size, 3, 256, 256).
+        images: torch tensor of shape (batch_size, 3, 256, 256), or the list
+            of the raw image bytes.
         targets: torch tensor of shape (batch_size, padded_length).
-        lengths: list; valid length for each padded caption.
+        lengths: torch int64 tensor of shape (batch_size); valid length for
+            each padded caption, kept on the CPU as `pack_padded_sequence`
+            expects.
+        ids: tuple of the caption ids.
+        indices: torch int64 tensor of shape (batch_size); dataset indices,
+            pinned by the loaders so that they are copied asynchronously.
     """
     # Sort a data list by caption length
     data.sort(key=lambda x: len(x[1]), reverse=True)
     images, captions, ids, img_ids, indices = zip(*data)
 
-    # Merge images (convert tuple of 3D tensor to 4D tensor)
-    images = torch.stack(images, 0)
+    # Merge images (convert tuple of 3D tensor to 4D tensor), raw image
+    # bytes have different sizes and are decoded later
+    if images[0].dtype == torch.uint8:
+        images = list(images)
+    else:
+        images = torch.stack(images, 0)
 
     # Merget captions (convert tuple of 1D tensor to 2D tensor)
-    lengths = [len(cap) for cap in captions]
-    targets = torch.zeros(len(captions), max(lengths)).long()
+    lengths = torch.LongTensor([len(cap) for cap in captions])
+    targets = torch.zeros(len(captions), int(lengths.max())).long()
     for i, cap in enumerate(captions):
-        end = lengths[i]
+        end = len(cap)
         targets[i, :end] = cap[:end]
 
+    indices = torch.LongTensor(indices)
+
     return images, targets, lengths, ids, indices
 
 
-def get_loader_single(data_name, split, root, json, vocab, transform,
-                      batch_size=100, shuffle=True,
-                      num_workers=2, ids=None, collate_fn=collate_fn):
-    """Returns torch.utils.data.DataLoader for custom coco dataset."""
+def get_batching(dataset, batch_size, shuffle, bucket_factor=0,
+                 distributed=False):
+    """DataLoader batching arguments, length-bucketed batches are only used
+    for shuffled (training) loaders with `bucket_factor > 0`. Distributed
+    training shards the dataset over the processes instead.
+    """
+    if distributed:
+        return {'batch_size': batch_size,
+                'sampler': data.DistributedSampler(
+                    dataset, shuffle=shuffle)}
+    if shuffle and bucket_factor > 0:
+        return {'batch_sampler': BucketSampler(dataset.caption_lengths(),
+                                               batch_size, bucket_factor)}
+    return {'batch_size': batch_size, 'shuffle': shuffle}
+
+
+def get_dataset_single(data_name, split, root, json, vocab, transform,
+                       ids=None, raw=False):
+    """Returns the dataset reading the full (non precomputed) images."""
     if 'coco' in data_name:
         # COCO custom dataset
         dataset = CocoDataset(root=root,
                               json=json,
                               vocab=vocab,
-                              transform=transform, ids=ids)
+                              transform=transform, ids=ids, raw=raw)
     elif 'f8k' in data_name or 'f30k' in data_name:
         dataset = FlickrDataset(root=root,
                                 split=split,
                                 json=json,
                                 vocab=vocab,
-                                transform=transform)
+                                transform=transform, raw=raw)
+    return dataset
+
+
+class GPUDecodeLoader(object):
+    """Wraps a DataLoader of raw JPEG bytes: every batch is decoded with
+    nvJPEG and transformed on the GPU, so the workers only read files.
+    Requires torchvision >= 0.10.
+    """
+
+    def __init__(self, data_loader, transform):
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.sampler = data_loader.sampler
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        mode = torchvision.io.ImageReadMode.RGB
+        for images, *rest in self.data_loader:
+            images = torch.stack([
+                self.transform(torchvision.io.decode_jpeg(
+                    image, mode=mode, device='cuda'))
+                for image in images], 0)
+            yield (images, *rest)
+
+
+def get_loader_single(data_name, split, root, json, vocab, transform,
+                      batch_size=100, shuffle=True,
+                      num_workers=2, ids=None, collate_fn=collate_fn,
+                      bucket_factor=0, distributed=False, gpu_decode=False):
+    """Returns torch.utils.data.DataLoader for custom coco dataset."""
+    # with gpu_decode the images are transformed after decoding, on the GPU
+    dataset = get_dataset_single(data_name, split, root, json, vocab,
+                                 None if gpu_decode else transform, ids,
+                                 raw=gpu_decode)
 
     # Data loader
     data_loader = torch.utils.data.DataLoader(dataset=dataset,
-                                              batch_size=batch_size,
-                                              shuffle=shuffle,
                                               pin_memory=True,
                                               num_workers=num_workers,
-                                              collate_fn=collate_fn)
+                                              collate_fn=collate_fn,
+                                              **get_batching(dataset,
+                                                             batch_size,
+                                                             shuffle,
+                                                             bucket_factor,
+                                                             distributed))
+    if gpu_decode:
+        data_loader = GPUDecodeLoader(data_loader, transform)
     return data_loader
 
 
 def get_precomp_loader(data_path, data_split, vocab, opt, batch_size=100,
-                       shuffle=True, num_workers=2):
+                       shuffle=True, num_workers=2, bucket_factor=0,
+                       distributed=False):
     """Returns torch.utils.data.DataLoader for custom coco dataset."""
     dset = PrecompDataset(data_path, data_split, vocab)
 
     data_loader = torch.utils.data.DataLoader(dataset=dset,
-                                              batch_size=batch_size,
-                                              shuffle=shuffle,
                                               pin_memory=True,
-                                              collate_fn=collate_fn)
+                                              collate_fn=collate_fn,
+                                              **get_batching(dset,
+                                                             batch_size,
+                                                             shuffle,
+                                                             bucket_factor,
+                                                             distributed))
     return data_loader
 
 
@@ -320,7 +465,11 @@ def get_transform(data_name, split_name, opt):
     elif split_name == 'test':
         t_list = [transforms.Resize(256), transforms.CenterCrop(224)]
 
-    t_end = [transforms.ToTensor(), normalizer]
+    if getattr(opt, 'gpu_decode', False):
+        # applied to decoded uint8 image tensors by `GPUDecodeLoader`
+        t_end = [transforms.ConvertImageDtype(torch.float), normalizer]
+    else:
+        t_end = [transforms.ToTensor(), normalizer]
     transform = transforms.Compose(t_list + t_end)
     return transform
 
@@ -329,7 +478,9 @@ def get_loaders(data_name, vocab, crop_size, batch_size, workers, opt):
     dpath = os.path.join(opt.data_path, data_name)
     if opt.data_name.endswith('_precomp'):
         train_loader = get_precomp_loader(dpath, 'train', vocab, opt,
-                                          batch_size, True, workers)
+                                          batch_size, True, workers,
+                                          bucket_factor=opt.bucket_factor,
+                                          distributed=opt.distributed)
         val_loader = get_precomp_loader(dpath, 'dev', vocab, opt,
                                         batch_size, False, workers)
     else:
@@ -343,7 +494,10 @@ def get_loaders(data_name, vocab, crop_size, batch_size, workers, opt):
                                          vocab, transform, ids=ids['train'],
                                          batch_size=batch_size, shuffle=True,
                                          num_workers=workers,
-                                         collate_fn=collate_fn)
+                                         collate_fn=collate_fn,
+                                         bucket_factor=opt.bucket_factor,
+                                         distributed=opt.distributed,
+                                         gpu_decode=opt.gpu_decode)
 
         transform = get_transform(data_name, 'val', opt)
         val_loader = get_loader_single(opt.data_name, 'val',
@@ -352,7 +506,8 @@ def get_loaders(data_name, vocab, crop_size, batch_size, workers, opt):
                                        vocab, transform, ids=ids['val'],
                                        batch_size=batch_size, shuffle=False,
                                        num_workers=workers,
-                                       collate_fn=collate_fn)
+                                       collate_fn=collate_fn,
+                                       gpu_decode=opt.gpu_decode)
 
     return train_loader, val_loader
 
@@ -374,6 +529,8 @@ def get_test_loader(split_name, data_name, vocab, crop_size, batch_size,
                                         vocab, transform, ids=ids[split_name],
                                         batch_size=batch_size, shuffle=False,
                                         num_workers=workers,
-                                        collate_fn=collate_fn)
+                                        collate_fn=collate_fn,
+                                        gpu_decode=getattr(opt, 'gpu_decode',
+                                                           False))
 
     return test_loader
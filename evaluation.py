@@ -130,6 +130,8 @@ def evalrank(opt_eval, split):
     opt = checkpoint['opt']
     if opt_eval.data_path is not None:
         opt.data_path = opt_eval.data_path
+    # evaluation always runs in a single process
+    opt.distributed = False
     print(opt)
     # load vocabulary used by the model
     with open(os.path.join(opt.vocab_path,
@@ -243,7 +245,10 @@ def i2t(images, captions, npts=None, measure='cosine',
         #print(npts)
     index_list = []
 
-    scores = images.dot(captions.T)
+    # only one of the 5 copies of each image is queried, and the order
+    # measure computes its own scores
+    if measure != 'order':
+        scores = images[::5].dot(captions.T)
 
     ranks = numpy.zeros(npts)
     top1 = numpy.zeros(npts)
@@ -263,7 +268,7 @@ def i2t(images, captions, npts=None, measure='cosine',
                 d2 = d2.cpu().numpy()
             d = d2[index % bs]
         else:
-            d = scores[5 * index]
+            d = scores[index]
         inds = numpy.argsort(d)[::-1]
         index_list.append(inds[0])
 
@@ -300,7 +305,8 @@ def t2i(images, captions, npts=None, measure='cosine',
         #print("# points:", npts)
     ims = numpy.array([images[i] for i in range(0, len(images), 5)])
 
-    scores = captions.dot(ims.T)
+    if measure != 'order':
+        scores = captions.dot(ims.T)
 
     ranks = numpy.zeros(5 * npts)
     top1 = numpy.zeros(5 * npts)
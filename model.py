@@ -3,20 +3,20 @@ import torch.nn as nn
 from torch.nn import functional as F
 import torch.nn.init
 import torchvision.models as models
-from torch.autograd import Variable
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence
 import torch.backends.cudnn as cudnn
 from torch.nn.utils.clip_grad import clip_grad_norm_
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
 from collections import OrderedDict
 from random import randint
+from contextlib import nullcontext
 
 def l2norm(X):
     """L2-normalize columns of X
     """
-    norm = torch.pow(X, 2).sum(dim=1, keepdim=True).sqrt()
-    X = torch.div(X, norm)
-    return X
+    # always in fp32, also under autocast
+    return F.normalize(X.float(), p=2, dim=1)
 
 
 def EncoderImage(data_name, img_dim, embed_size, finetune=False,
@@ -46,8 +46,9 @@ class EncoderImageFull(nn.Module):
         self.no_imgnorm = no_imgnorm
         self.use_abs = use_abs
 
-        # Load a pre-trained model
+        # Load a pre-trained model, NHWC lets cuDNN use tensor-core kernels
         self.cnn = self.get_cnn(cnn_type, True)
+        self.cnn = self.cnn.to(memory_format=torch.channels_last)
 
         # For efficient memory usage.
         for param in self.cnn.parameters():
@@ -60,13 +61,14 @@ class EncoderImageFull(nn.Module):
             self.cnn.classifier = nn.Sequential(
                 *list(self.cnn.classifier.children())[:-1])
         elif cnn_type.startswith('resnet'):
-            self.fc = nn.Linear(self.cnn.module.fc.in_features, embed_size)
-            self.cnn.module.fc = nn.Sequential()
+            self.fc = nn.Linear(self.cnn.fc.in_features, embed_size)
+            self.cnn.fc = nn.Sequential()
 
         self.init_weights()
 
     def get_cnn(self, arch, pretrained):
-        """Load a pretrained CNN and parallelize over GPUs
+        """Load a pretrained CNN, multi-GPU training is handled by
+        DistributedDataParallel in `VSE`
         """
         if pretrained:
             print("=> using pre-trained model '{}'".format(arch))
@@ -75,18 +77,15 @@ class EncoderImageFull(nn.Module):
             print("=> creating model '{}'".format(arch))
             model = models.__dict__[arch]()
 
-        if arch.startswith('alexnet') or arch.startswith('vgg'):
-            model.features = nn.DataParallel(model.features)
-            model.cuda()
-        else:
-            model = nn.DataParallel(model).cuda()
-
         return model
 
     def load_state_dict(self, state_dict):
         """
-        Handle the models saved before commit pytorch/vision@989d52a
+        Handle the models saved before commit pytorch/vision@989d52a and
+        the models saved with a DataParallel wrapped CNN
         """
+        state_dict = OrderedDict((k.replace('module.', ''), v)
+                                 for k, v in state_dict.items())
         if 'cnn.classifier.1.weight' in state_dict:
             state_dict['cnn.classifier.0.weight'] = state_dict[
                 'cnn.classifier.1.weight']
@@ -111,12 +110,18 @@ class EncoderImageFull(nn.Module):
         self.fc.weight.data.uniform_(-r, r)
         self.fc.bias.data.fill_(0)
 
-    def forward(self, images):
-        """Extract image feature vectors."""
+    def cnn_features(self, images):
+        """L2-normalized CNN features, as stored by precompute_features.py
+        """
+        images = images.contiguous(memory_format=torch.channels_last)
         features = self.cnn(images)
 
         # normalization in the image embedding space
-        features = l2norm(features)
+        return l2norm(features)
+
+    def forward(self, images):
+        """Extract image feature vectors."""
+        features = self.cnn_features(images)
 
         # linear projection to the joint embedding space
         features = self.fc(features)
@@ -207,16 +212,13 @@ class EncoderText(nn.Module):
         """
         # Embed word ids to vectors
         x = self.embed(x)
-        packed = pack_padded_sequence(x, lengths, batch_first=True)
-
-        # Forward propagate RNN
-        out, _ = self.rnn(packed)
+        packed = pack_padded_sequence(x, lengths, batch_first=True,
+                                      enforce_sorted=True)
 
-        # Reshape *final* output to (batch_size, hidden_size)
-        padded = pad_packed_sequence(out, batch_first=True)
-        I = torch.LongTensor(lengths).view(-1, 1, 1)
-        I = Variable(I.expand(x.size(0), 1, self.embed_size)-1).cuda()
-        out = torch.gather(padded[0], 1, I).squeeze(1)
+        # Forward propagate RNN, the *final* hidden state of the last layer
+        # is the output at the last valid step of each caption
+        _, h_n = self.rnn(packed)
+        out = h_n[-1]
 
         # normalization in the joint embedding space
         out = l2norm(out)
@@ -231,16 +233,172 @@ class EncoderText(nn.Module):
 def cosine_sim(im, s):
     """Cosine similarity between all the image and sentence pairs
     """
-    return im.mm(s.t())
+    return torch.matmul(im, s.transpose(-1, -2))
+
+
+def cosine_sim_t(im, s_t):
+    """`cosine_sim` against a pre-transposed (dim, n_s) right-hand side
+    """
+    return torch.matmul(im, s_t)
+
+
+# upper bound on the number of elements of a `s - im` difference block
+ORDER_SIM_NUMEL = 2 ** 24
+
+
+def _order_sim_blocks(im, s):
+    """Yield (start, YmX) blocks of $max(0, s-im)$ over rows of `s`, each of
+    shape (block, n_im, dim), so that the full (n_s, n_im, dim) tensor is
+    never materialized.
+    """
+    block = max(1, ORDER_SIM_NUMEL // max(1, im.size(0) * im.size(1)))
+    for i in range(0, s.size(0), block):
+        YmX = (s[i:i + block].unsqueeze(1) - im.unsqueeze(0)).clamp(min=0)
+        yield i, YmX
+
+
+class OrderSim(torch.autograd.Function):
+    """Blocked order similarity. The backward pass recomputes each block
+    instead of keeping the (n_s, n_im, dim) intermediates alive.
+    """
+
+    @staticmethod
+    def forward(ctx, im, s):
+        ctx.save_for_backward(im, s)
+        score = [-YmX.pow(2).sum(2).sqrt().t()
+                 for _, YmX in _order_sim_blocks(im, s)]
+        return torch.cat(score, 1)
+
+    @staticmethod
+    def backward(ctx, grad_score):
+        im, s = ctx.saved_tensors
+        grad_im = torch.zeros_like(im)
+        grad_s = torch.zeros_like(s)
+        for i, YmX in _order_sim_blocks(im, s):
+            norm = YmX.pow(2).sum(2, keepdim=True).sqrt()
+            g = grad_score[:, i:i + YmX.size(0)].t().unsqueeze(2)
+            # d(-norm)/dYmX = -YmX / norm, zero wherever YmX is clamped
+            d = -g * YmX / norm.clamp(min=1e-12)
+            grad_s[i:i + YmX.size(0)] = d.sum(1)
+            grad_im -= d.sum(0)
+        return grad_im, grad_s
 
 
 def order_sim(im, s):
     """Order embeddings similarity measure $max(0, s-im)$
     """
-    YmX = (s.unsqueeze(1).expand(s.size(0), im.size(0), s.size(1))
-           - im.unsqueeze(0).expand(s.size(0), im.size(0), s.size(1)))
-    score = -YmX.clamp(min=0).pow(2).sum(2).sqrt().t()
-    return score
+    return OrderSim.apply(im, s)
+
+
+def order_sim_t(im, s_t):
+    """`order_sim` against a pre-transposed (dim, n_s) right-hand side
+    """
+    return order_sim(im, s_t.t())
+
+
+def bank_tiles(tiles, device):
+    """Iterate over the memory bank tiles on `device`. Tiles kept in pinned
+    host memory are copied on a side stream one tile ahead, so that the
+    copy of the next tile overlaps the gemm of the current one.
+    """
+    if tiles[0].device == device or device.type != 'cuda':
+        for tile in tiles:
+            yield tile
+        return
+
+    main = torch.cuda.current_stream(device)
+    copy = torch.cuda.Stream(device)
+
+    def fetch(tile):
+        with torch.cuda.stream(copy):
+            return tile.to(device, non_blocking=True)
+
+    nxt = fetch(tiles[0])
+    for i in range(len(tiles)):
+        main.wait_stream(copy)
+        tile = nxt
+        # allocated on the copy stream, do not reuse it before the main
+        # stream is done with it
+        tile.record_stream(main)
+        if i + 1 < len(tiles):
+            nxt = fetch(tiles[i + 1])
+        yield tile
+
+
+def bank_topk(sim_t, q, tiles, in_batch, k):
+    """Unsorted top-k similarities of the queries `q` against the tiled,
+    transposed memory bank, the items masked by `in_batch` excluded. Each
+    tile is merged into a running top-k so that the full (n_q, n_mb) score
+    matrix is never materialized.
+    """
+    topk = None
+    j = 0
+    for tile in bank_tiles(tiles, q.device):
+        # the bank may be stored in half precision
+        scores = sim_t(q.to(tile.dtype), tile).float()
+        scores.masked_fill_(in_batch[:, j:j + tile.size(1)], float('-inf'))
+        j += tile.size(1)
+        if topk is not None:
+            scores = torch.cat((topk, scores), 1)
+        topk = torch.topk(scores, min(k, scores.size(1)), sorted=False).values
+    return topk
+
+
+@torch.jit.script
+def global_weights(topk_i2t, topk_t2i, s_diag, g_alpha: float, g_beta: float,
+                   g_ep_posi: float, g_ep_nega: float):
+    """Global weights W_it (negative pairs) and W_ii (positive pairs) from
+    the top-k memory bank scores of each image / caption and the scores of
+    the positive pairs. Scripted so that the exp/sum/div chain is fused.
+    """
+    # negative
+    i2t_k_avg = torch.exp(g_beta * topk_i2t - g_ep_nega).sum(1).view(-1, 1)
+    t2i_k_avg = torch.exp(g_beta * topk_t2i - g_ep_nega).sum(1).view(1, -1)
+
+    exp_sii = torch.exp(g_beta * s_diag)
+    k_avg = i2t_k_avg + t2i_k_avg
+    wit = k_avg / (k_avg + exp_sii.view(-1, 1) + exp_sii.view(1, -1))
+
+    # positive
+    i2t_k_avg_positive = torch.exp(g_alpha * (topk_i2t - g_ep_posi)).sum(1)
+    t2i_k_avg_positive = torch.exp(g_alpha * (topk_t2i - g_ep_posi)).sum(1)
+
+    exp_sii = torch.exp(g_alpha * (s_diag - g_ep_posi))
+    wii = 1 - exp_sii / (exp_sii + i2t_k_avg_positive + t2i_k_avg_positive)
+
+    return wit, wii
+
+
+@torch.jit.script
+def log_sum_loss(S_, loss_diag, l_alpha: float):
+    """Reduce the exponentiated negative scores `S_` and the positive pair
+    terms `loss_diag` to the batch loss
+    """
+    return torch.sum(
+            torch.log(1 + S_.sum(0)) / l_alpha
+            + torch.log(1 + S_.sum(1)) / l_alpha
+            + loss_diag
+            ) / S_.size(0)
+
+
+@torch.jit.script
+def local_loss(scores_, s_diag, l_alpha: float, l_ep: float):
+    """Local loss from the scores with a zeroed diagonal `scores_` and the
+    scores of the positive pairs `s_diag`
+    """
+    S_ = torch.exp(l_alpha * (scores_ - l_ep))
+    loss_diag = - torch.log(1 + torch.relu(s_diag))
+    return log_sum_loss(S_, loss_diag, l_alpha)
+
+
+@torch.jit.script
+def weighted_local_loss(scores_, s_diag, wit, wii, l_alpha: float,
+                        l_ep: float):
+    """`local_loss` with the global (constant) weights W_it and W_ii
+    """
+    S_ = torch.exp(l_alpha * wit * (scores_ - l_ep))
+    loss_diag = - torch.log(1 + torch.relu(s_diag * wii))
+    return log_sum_loss(S_, loss_diag, l_alpha)
 
 
 class ContrastiveLoss(nn.Module):
@@ -253,8 +411,10 @@ class ContrastiveLoss(nn.Module):
 
         if opt.measure == 'order':
             self.sim = order_sim
+            self.sim_t = order_sim_t
         else:
             self.sim = cosine_sim
+            self.sim_t = cosine_sim_t
 
         self.opt = opt
 
@@ -268,7 +428,11 @@ class ContrastiveLoss(nn.Module):
         self.l_alpha = self.opt.local_alpha
         self.l_ep = self.opt.local_ep
 
-    def forward(self, im, s, mb_img, mb_cap, mb_ind, indices):
+    def forward(self, im, s, mb_img_t, mb_cap_t, mb_ind, indices):
+        """`mb_img_t` and `mb_cap_t` are the transposed (dim, n_mb) memory
+        bank embeddings split in column tiles, `mb_ind` the dataset
+        indices of the bank items.
+        """
 
         bsize = im.size()[0]
 
@@ -283,12 +447,9 @@ class ContrastiveLoss(nn.Module):
             cost_s = (self.opt.margin + scores - d1).clamp(min=0)
             cost_im = (self.opt.margin + scores - d2).clamp(min=0)
 
-            mask = torch.eye(bsize) > .5
-            I = Variable(mask)
-            if torch.cuda.is_available():
-                I = I.cuda()
-            cost_s = cost_s.masked_fill_(I, 0)
-            cost_im = cost_im.masked_fill_(I, 0)
+            # clear the positive pairs in-place, no mask needed
+            cost_s.fill_diagonal_(0)
+            cost_im.fill_diagonal_(0)
 
             if self.opt.max_violation:
 
@@ -297,63 +458,51 @@ class ContrastiveLoss(nn.Module):
 
             return cost_s.sum() + cost_im.sum()
 
-        tmp  = torch.eye(bsize).cuda()
+        # positive pair scores and the scores with a zeroed diagonal
+        s_diag = scores.diag()
+        scores_ = scores.clone()
+        scores_.fill_diagonal_(0)
 
-        s_diag = tmp * scores
-        scores_ = scores - s_diag
-
-        if mb_img is not None:
+        if mb_img_t is not None:
 
             #negative
             mb_k = self.opt.mb_k
             if im.size()[0] < mb_k: mb_k = bsize
 
-            used_ind = torch.tensor([0 if i in indices else 1 for i in mb_ind]).bool().cuda()
-
-            mb_img = mb_img[used_ind]
-            mb_cap = mb_cap[used_ind]
-
-            scores_img_glob = self.sim(im, mb_cap)
-            i2t_k_avg = torch.exp(self.g_beta * torch.topk(scores_img_glob, mb_k)[0] - self.g_ep_nega).sum(1).reshape((bsize,1))
-            i2t_k_avg_positive = torch.exp(self.g_alpha * (torch.topk(scores_img_glob, mb_k)[0] - self.g_ep_posi)).sum(1)
-
-            scores_cap_glob = self.sim(s, mb_img)
-            t2i_k_avg = torch.exp(self.g_beta * torch.topk(scores_cap_glob, mb_k)[0] - self.g_ep_nega).sum(1).reshape((1,bsize))
-            t2i_k_avg_positive = torch.exp(self.g_alpha * (torch.topk(scores_cap_glob, mb_k)[0] - self.g_ep_posi)).sum(1)
-
-            tmp_i2t = i2t_k_avg.repeat(1, bsize)
-            tmp_t2i = t2i_k_avg.repeat(bsize, 1)
-
-            exp_sii = torch.exp(self.g_beta * s_diag.sum(0))
-            tmp_expii = exp_sii.reshape((bsize,1)).repeat(1, bsize)
-            tmp_exptt = exp_sii.reshape((1,bsize)).repeat(bsize, 1)
-
-            wit = (tmp_i2t + tmp_t2i) / (tmp_i2t + tmp_t2i + tmp_expii + tmp_exptt)
-
-            #positive
-            exp_sii = torch.exp(self.g_alpha * (s_diag.sum(0) - self.g_ep_posi))
-
-            wii = 1 - exp_sii / (exp_sii + i2t_k_avg_positive + t2i_k_avg_positive)
+            # the global weights are detached, no graph is needed for them;
+            # each top-k is only summed over, so it is left unsorted
+            with torch.no_grad():
+                # ignore the memory bank items of the current batch, the
+                # bank itself is left untouched
+                indices = indices.to(mb_ind.device, non_blocking=True)
+                in_batch = (mb_ind.view(-1, 1) == indices.view(1, -1)).any(1)
+                in_batch = in_batch.view(1, -1)
 
-            wit = wit - wit * tmp
+                topk_i2t = bank_topk(self.sim_t, im, mb_cap_t, in_batch, mb_k)
+                topk_t2i = bank_topk(self.sim_t, s, mb_img_t, in_batch, mb_k)
+                wit, wii = global_weights(
+                        topk_i2t, topk_t2i, s_diag,
+                        self.g_alpha, self.g_beta,
+                        self.g_ep_posi, self.g_ep_nega)
 
-            S_ = torch.exp(self.l_alpha * wit.detach() * (scores_ - self.l_ep))
+            wit.fill_diagonal_(0)
 
-            loss_diag = - torch.log(1 + F.relu((s_diag.sum(0) * wii.detach())))
+            loss = weighted_local_loss(scores_, s_diag, wit, wii,
+                                       self.l_alpha, self.l_ep)
 
         else:
 
-            S_ = torch.exp(self.l_alpha * (scores_ - self.l_ep))
+            loss = local_loss(scores_, s_diag, self.l_alpha, self.l_ep)
 
-            loss_diag = - torch.log(1 + F.relu(s_diag.sum(0)))
+        return loss
 
-        loss = torch.sum(
-                torch.log(1 + S_.sum(0)) / self.l_alpha \
-                + torch.log(1 + S_.sum(1)) / self.l_alpha \
-                + loss_diag
-                ) / bsize
 
-        return loss
+def unwrap(module):
+    """Return the module wrapped by DistributedDataParallel, if any
+    """
+    if isinstance(module, DistributedDataParallel):
+        return module.module
+    return module
 
 
 class VSE(object):
@@ -378,9 +527,10 @@ class VSE(object):
             cudnn.benchmark = True
 
         # memory bank
-        self.mb_img = None
-        self.mb_cap = None
-        self.mb_ind = None
+        self.mb_half = getattr(opt, 'mb_half', False)
+        self.mb_chunk = getattr(opt, 'mb_chunk', 0)
+        self.mb_offload = getattr(opt, 'mb_offload', False)
+        self.set_memory_bank(None, None, None)
 
         # Loss and Optimizer
         self.criterion = ContrastiveLoss(opt=opt)
@@ -392,15 +542,54 @@ class VSE(object):
 
         self.optimizer = torch.optim.Adam(params, lr=opt.learning_rate)
 
+        # mixed precision training, requires torch >= 1.6
+        self.amp = getattr(opt, 'amp', False)
+        if self.amp:
+            self.scaler = torch.cuda.amp.GradScaler()
+
+        # one process per GPU, gradients are all-reduced by DDP
+        if getattr(opt, 'distributed', False):
+            self.img_enc = DistributedDataParallel(
+                    self.img_enc, device_ids=[opt.local_rank])
+            self.txt_enc = DistributedDataParallel(
+                    self.txt_enc, device_ids=[opt.local_rank])
+
         self.Eiters = 0
 
+    def set_memory_bank(self, mb_img, mb_cap, mb_ind):
+        """Set (or clear, with None) the memory bank. The embeddings are
+        stored transposed so that the per-step bank similarity is a single
+        gemm against a contiguous operand, and in fp16 with `--mb_half`.
+        With `--mb_chunk` the bank is split in tiles of that many items,
+        scored one at a time, and with `--mb_offload` the tiles are kept in
+        pinned host memory and streamed to the GPU.
+        """
+        if mb_img is None:
+            self.mb_img_t = self.mb_cap_t = self.mb_ind = None
+            return
+        if self.mb_half:
+            mb_img, mb_cap = mb_img.half(), mb_cap.half()
+        chunk = self.mb_chunk if self.mb_chunk > 0 else mb_img.size(0)
+
+        def tiles(mb):
+            tiles = [t.contiguous() for t in mb.t().split(chunk, 1)]
+            if self.mb_offload:
+                tiles = [t.cpu().pin_memory() for t in tiles]
+            return tiles
+
+        self.mb_img_t = tiles(mb_img)
+        self.mb_cap_t = tiles(mb_cap)
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.mb_ind = torch.as_tensor(mb_ind, device=device)
+
     def state_dict(self):
-        state_dict = [self.img_enc.state_dict(), self.txt_enc.state_dict()]
+        state_dict = [unwrap(self.img_enc).state_dict(),
+                      unwrap(self.txt_enc).state_dict()]
         return state_dict
 
     def load_state_dict(self, state_dict):
-        self.img_enc.load_state_dict(state_dict[0])
-        self.txt_enc.load_state_dict(state_dict[1])
+        unwrap(self.img_enc).load_state_dict(state_dict[0])
+        unwrap(self.txt_enc).load_state_dict(state_dict[1])
 
     def train_start(self):
         """switch to train mode
@@ -417,22 +606,28 @@ class VSE(object):
     def forward_emb(self, images, captions, lengths, volatile=False,**kwargs):
         """Compute the image and caption embeddings
         """
-        # Set mini-batch dataset
-        if volatile:
-            with torch.no_grad():
-                images = Variable(images)
-                captions = Variable(captions)
-        else:
-            images = Variable(images)
-            captions = Variable(captions)
-
+        # Set mini-batch dataset, the loaders use pinned memory so that
+        # the copies are asynchronous
         if torch.cuda.is_available():
-            images = images.cuda()
-            captions = captions.cuda()
+            images = images.cuda(non_blocking=True)
+            captions = captions.cuda(non_blocking=True)
+
+        img_enc, txt_enc = self.img_enc, self.txt_enc
+        if volatile or not torch.is_grad_enabled():
+            # nothing to all-reduce: skip the DDP wrappers, their buffer
+            # broadcasts would not be matched by the other ranks when only
+            # some of them run (validation on rank 0, memory bank loading)
+            img_enc, txt_enc = unwrap(img_enc), unwrap(txt_enc)
+        elif isinstance(txt_enc, DistributedDataParallel):
+            # DDP moves the tensor arguments to the GPU while
+            # pack_padded_sequence needs the lengths on the CPU, a list is
+            # left alone
+            lengths = lengths.tolist()
 
         # Forward
-        img_emb = self.img_enc(images)
-        cap_emb = self.txt_enc(captions, lengths)
+        with torch.no_grad() if volatile else nullcontext():
+            img_emb = img_enc(images)
+            cap_emb = txt_enc(captions, lengths)
         return img_emb, cap_emb
 
     def forward_loss(self, img_emb, cap_emb, indices, **kwargs):
@@ -441,8 +636,8 @@ class VSE(object):
         loss = self.criterion(
                 img_emb,
                 cap_emb,
-                self.mb_img,
-                self.mb_cap,
+                self.mb_img_t,
+                self.mb_cap_t,
                 self.mb_ind,
                 indices)
         self.logger.update('Loss', loss.item(), img_emb.size(0))
@@ -456,14 +651,25 @@ class VSE(object):
         self.logger.update('lr', self.optimizer.param_groups[0]['lr'])
 
         # compute the embeddings
-        img_emb, cap_emb = self.forward_emb(images, captions, lengths)
+        autocast = torch.cuda.amp.autocast if self.amp else nullcontext
+        with autocast():
+            img_emb, cap_emb = self.forward_emb(images, captions, lengths)
 
-        # measure accuracy and record loss
+        # measure accuracy and record loss, the loss exponentiates scaled
+        # scores and is kept in fp32
         self.optimizer.zero_grad()
-        loss = self.forward_loss(img_emb, cap_emb, indices)
+        loss = self.forward_loss(img_emb.float(), cap_emb.float(), indices)
 
         # compute gradient and do SGD step
-        loss.backward()
+        if self.amp:
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.optimizer)
+        else:
+            loss.backward()
         if self.grad_clip > 0:
             clip_grad_norm_(self.params, self.grad_clip)
-        self.optimizer.step()
+        if self.amp:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
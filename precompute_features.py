@@ -0,0 +1,141 @@
+"""Precompute the CNN features of a full image dataset in the format read by
+`data.PrecompDataset`, so that models with a frozen CNN can be trained on
+`<out_path>/<data_name>_precomp` without running the CNN every epoch.
+"""
+import os
+import pickle
+import argparse
+
+import numpy as np
+import torch
+import torch.utils.data
+
+import data
+from vocab import Vocabulary  # NOQA
+from model import EncoderImageFull
+
+# split names of `data.get_paths` -> split names of `data.PrecompDataset`
+SPLITS = {'train': 'train', 'val': 'dev', 'test': 'test'}
+
+
+def get_image_step(dataset):
+    """Returns 5 if every image has 5 consecutive captions, in which case a
+    single feature row is stored per image (`PrecompDataset` divides the
+    index by 5), and 1 otherwise (one feature row per caption).
+    """
+    img_ids = [dataset.caption_info(i)[1] for i in range(len(dataset))]
+    if len(img_ids) % 5 == 0 and all(
+            img_ids[i] == img_ids[i - i % 5] for i in range(len(img_ids))):
+        return 5
+    return 1
+
+
+def get_out_files(opt, split):
+    """Returns the feature and caption files written for `split`"""
+    out_path = os.path.join(opt.out_path, opt.data_name + '_precomp')
+    return (os.path.join(out_path, '%s_ims.npy' % SPLITS[split]),
+            os.path.join(out_path, '%s_caps.txt' % SPLITS[split]))
+
+
+def precompute(opt, enc, vocab, split):
+    dpath = os.path.join(opt.data_path, opt.data_name)
+    ims_name, caps_name = get_out_files(opt, split)
+    roots, ids = data.get_paths(dpath, opt.data_name, opt.use_restval)
+
+    # the stored features are not augmented, use the evaluation transform
+    transform = data.get_transform(opt.data_name, 'val', opt)
+    dataset = data.get_dataset_single(opt.data_name, split,
+                                      roots[split]['img'],
+                                      roots[split]['cap'],
+                                      vocab, transform, ids=ids[split])
+    step = get_image_step(dataset)
+    rows = list(range(0, len(dataset), step))
+    data_loader = torch.utils.data.DataLoader(
+            dataset=torch.utils.data.Subset(dataset, rows),
+            batch_size=opt.batch_size,
+            shuffle=False,
+            pin_memory=True,
+            num_workers=opt.workers,
+            collate_fn=data.collate_fn)
+
+    # memory-mapped so that the features never have to fit in RAM
+    ims = None
+    with torch.no_grad():
+        for i, (images, _, _, ids, _) in enumerate(data_loader):
+            if torch.cuda.is_available():
+                images = images.cuda(non_blocking=True)
+            features = enc.cnn_features(images).cpu().numpy()
+
+            if ims is None:
+                ims = np.lib.format.open_memmap(
+                        ims_name, mode='w+', dtype=np.float32,
+                        shape=(len(rows), features.shape[1]))
+            # collate_fn sorts the batch by caption length
+            ims[np.asarray(ids) // step] = features
+
+            if i % opt.log_step == 0:
+                print("[%d/%d] %s images encoded."
+                      % (i, len(data_loader), split))
+    ims.flush()
+
+    with open(caps_name, 'w') as f:
+        for i in range(len(dataset)):
+            caption = dataset.caption_info(i)[0]
+            f.write(' '.join(str(caption).split()) + '\n')
+
+    print("Saved %s features %s to %s" % (split, ims.shape, ims_name))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', default='/w/31/faghri/vsepp_data/',
+                        help='path to datasets')
+    parser.add_argument('--out_path', default='./precomp/',
+                        help='path to write <data_name>_precomp to, kept '
+                        'apart from the downloaded _precomp features')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Overwrite existing precomputed features.')
+    parser.add_argument('--data_name', default='coco',
+                        help='coco|f8k|f30k')
+    parser.add_argument('--vocab_path', default='./vocab/',
+                        help='Path to saved vocabulary pickle files.')
+    parser.add_argument('--cnn_type', default='vgg19',
+                        help="""The CNN used for image encoder
+                        (e.g. vgg19, resnet152)""")
+    parser.add_argument('--splits', default='train,val,test',
+                        help='Comma separated splits to precompute.')
+    parser.add_argument('--use_restval', action='store_true',
+                        help='Use the restval data for training on MSCOCO.')
+    parser.add_argument('--batch_size', default=128, type=int,
+                        help='Number of images encoded at once.')
+    parser.add_argument('--workers', default=10, type=int,
+                        help='Number of data loader workers.')
+    parser.add_argument('--log_step', default=10, type=int,
+                        help='Number of steps to print the progress.')
+    opt = parser.parse_args()
+    print(opt)
+
+    splits = opt.splits.split(',')
+    existing = [f for split in splits for f in get_out_files(opt, split)
+                if os.path.exists(f)]
+    if existing and not opt.overwrite:
+        raise SystemExit("%s already exist(s), pass --overwrite to "
+                         "replace" % ', '.join(existing))
+
+    vocab = pickle.load(open(os.path.join(
+        opt.vocab_path, '%s_vocab.pkl' % opt.data_name), 'rb'))
+
+    # only the CNN of the encoder is used
+    enc = EncoderImageFull(1024, cnn_type=opt.cnn_type)
+    if torch.cuda.is_available():
+        enc.cuda()
+    enc.eval()
+
+    os.makedirs(os.path.join(opt.out_path, opt.data_name + '_precomp'),
+                exist_ok=True)
+    for split in splits:
+        precompute(opt, enc, vocab, split)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import shutil
 from random import random
 import argparse
 import torch
+import torch.distributed as dist
 import logging
 import tensorboard_logger as tb_logger 
 
@@ -91,12 +92,47 @@ def main():
                         help="Use top K items in memory bank")
     parser.add_argument('--mb_rate', default=0.05, type=float,
                         help="-")
+    parser.add_argument('--mb_half', action='store_true',
+                        help="Store the memory bank in half precision")
+    parser.add_argument('--mb_chunk', default=0, type=int,
+                        help="Score the memory bank in tiles of mb_chunk "
+                        "items, merging a running top-k (0: one gemm)")
+    parser.add_argument('--mb_offload', action='store_true',
+                        help="Keep the memory bank in pinned host memory "
+                        "and stream its tiles to the GPU")
+    parser.add_argument('--bucket_factor', default=0, type=int,
+                        help="Batch training captions of similar length "
+                        "within buckets of bucket_factor batches (0: off), "
+                        "ignored in distributed runs")
+    parser.add_argument('--gpu_decode', action='store_true',
+                        help="Decode and transform the JPEG images on the "
+                        "GPU, few workers are then needed "
+                        "(requires torchvision >= 0.10)")
+    parser.add_argument('--amp', action='store_true',
+                        help="Compute the embeddings with mixed precision "
+                        "(requires torch >= 1.6)")
+    parser.add_argument('--local_rank', default=0, type=int,
+                        help="GPU of this process, set by "
+                        "torch.distributed.launch")
 
     opt = parser.parse_args()
+
+    # one process per GPU when started with torch.distributed.launch,
+    # batch_size is then the per-GPU batch size
+    opt.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    opt.rank = 0
+    if opt.distributed:
+        torch.cuda.set_device(opt.local_rank)
+        dist.init_process_group('nccl', init_method='env://')
+        opt.rank = dist.get_rank()
     print(opt)
 
     logging.basicConfig(format='%(message)s', level=logging.INFO)
-    tb_logger.configure(opt.logger_name, flush_secs=5)
+    if opt.distributed and opt.bucket_factor > 0:
+        # the DistributedSampler shards the dataset without length buckets
+        logging.warning('--bucket_factor is ignored in distributed runs')
+    if opt.rank == 0:
+        tb_logger.configure(opt.logger_name, flush_secs=5)
 
     # Load Vocabulary Wrapper
     vocab = pickle.load(open(os.path.join(
@@ -115,7 +151,11 @@ def main():
     if opt.resume:
         if os.path.isfile(opt.resume):
             print("=> loading checkpoint '{}'".format(opt.resume))
-            checkpoint = torch.load(opt.resume)
+            # each process loads the checkpoint onto its own GPU
+            map_location = None
+            if opt.distributed:
+                map_location = 'cuda:%d' % opt.local_rank
+            checkpoint = torch.load(opt.resume, map_location=map_location)
             start_epoch = checkpoint['epoch']
             best_rsum = checkpoint['best_rsum']
             model.load_state_dict(checkpoint['model'])
@@ -124,7 +164,8 @@ def main():
             model.Eiters = checkpoint['Eiters']
             print("=> loaded checkpoint '{}' (epoch {}, best_rsum {})"
                   .format(opt.resume, start_epoch, best_rsum))
-            validate(opt, val_loader, model)
+            if opt.rank == 0:
+                validate(opt, val_loader, model)
         else:
             print("=> no checkpoint found at '{}'".format(opt.resume))
 
@@ -132,6 +173,8 @@ def main():
     best_rsum = 0
     for epoch in range(opt.num_epochs):
         adjust_learning_rate(opt, model.optimizer, epoch)
+        if opt.distributed:
+            train_loader.sampler.set_epoch(epoch)
 
         memory_bank = opt.memory_bank
         if memory_bank and epoch > 0:
@@ -139,27 +182,28 @@ def main():
         # train for one epoch
         train(opt, train_loader, model, epoch, val_loader)
 
-        # evaluate on validation set
-        rsum = validate(opt, val_loader, model)
-        print ("rsum: %.1f" % rsum)
-        if opt.record_val:
-            with open("rst_val_" + opt.logger_name[5:], "a") as f:
-                f.write("Epoch: %d ; rsum: %.1f\n" %(epoch, rsum))
-
-        # remember best R@ sum and save checkpoint
-        is_best = rsum > best_rsum
-        best_rsum = max(rsum, best_rsum)
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'model': model.state_dict(),
-            'best_rsum': best_rsum,
-            'opt': opt,
-            'Eiters': model.Eiters,
-        }, is_best, prefix=opt.logger_name + '/', save_all=opt.save_all)
+        # only the first process evaluates and saves checkpoints
+        if opt.rank == 0:
+            # evaluate on validation set
+            rsum = validate(opt, val_loader, model)
+            print ("rsum: %.1f" % rsum)
+            if opt.record_val:
+                with open("rst_val_" + opt.logger_name[5:], "a") as f:
+                    f.write("Epoch: %d ; rsum: %.1f\n" %(epoch, rsum))
+
+            # remember best R@ sum and save checkpoint
+            is_best = rsum > best_rsum
+            best_rsum = max(rsum, best_rsum)
+            save_checkpoint({
+                'epoch': epoch + 1,
+                'model': model.state_dict(),
+                'best_rsum': best_rsum,
+                'opt': opt,
+                'Eiters': model.Eiters,
+            }, is_best, prefix=opt.logger_name + '/', save_all=opt.save_all)
 
         # reset memory bank
-        model.mb_img = None
-        model.mb_cap = None
+        model.set_memory_bank(None, None, None)
 
 def load_memory_bank(opt, train_loader, model):
     mb_img, mb_cap, ind = None, None, None
@@ -174,6 +218,9 @@ def load_memory_bank(opt, train_loader, model):
         with torch.no_grad():
             imgs, caps, lengths, _, indices = train_data
             img_emb, cap_emb = model.forward_emb(imgs, caps, lengths)
+        if opt.mb_offload:
+            # do not build the whole bank on the GPU
+            img_emb, cap_emb = img_emb.cpu(), cap_emb.cpu()
 
         if mb_img is None:
             mb_img = img_emb
@@ -182,14 +229,12 @@ def load_memory_bank(opt, train_loader, model):
         else:
             mb_img = torch.cat((mb_img, img_emb), 0)
             mb_cap = torch.cat((mb_cap, cap_emb), 0)
-            ind = ind + indices
-    model.mb_img = mb_img
-    model.mb_cap = mb_cap
-    model.mb_ind = ind
+            ind = torch.cat((ind, indices), 0)
+    model.set_memory_bank(mb_img, mb_cap, ind)
 
     print ('[memory bank fully loaded!]')
-    print ("MB(Image): ", model.mb_img.size())
-    print ("MB(Caption): ", model.mb_cap.size())
+    print ("MB(Image): ", mb_img.size())
+    print ("MB(Caption): ", mb_cap.size())
     print ("indices len:",len(model.mb_ind))
 
 def train(opt, train_loader, model, epoch, val_loader):
@@ -227,6 +272,9 @@ def train(opt, train_loader, model, epoch, val_loader):
                     epoch, i, len(train_loader), batch_time=batch_time,
                     data_time=data_time, e_log=str(model.logger)))
 
+        if opt.rank != 0:
+            continue
+
         # Record logs in tensorboard
         tb_logger.log_value('epoch', epoch, step=model.Eiters)
         tb_logger.log_value('step', i, step=model.Eiters)